@@ -1,256 +1,482 @@
 import os
-import json
-from flask import Flask, request
-from linebot.v3 import WebhookHandler
-from linebot.v3.messaging import MessagingApi, Configuration as LineConfiguration, ApiClient
+import re
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import orjson
+import msgspec
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
+from linebot.v3.messaging import AsyncMessagingApi, Configuration as LineConfiguration, AsyncApiClient
 from linebot.v3.messaging.models import (
     TextMessage,
     ReplyMessageRequest,
+    PushMessageRequest,
 )
-from linebot.v3.webhooks import (
-    MessageEvent,
-    TextMessageContent,
-)
-from linebot.v3.exceptions import InvalidSignatureError
-import requests
-from openai import OpenAI
-from datetime import datetime
+from linebot.v3.webhooks import MessageEvent
+import httpx
+import redis.asyncio as redis
+from cachetools import TTLCache
+from openai import AsyncOpenAI
+import time
+from datetime import datetime, timedelta
 from typing import Optional
 
-# Initialize Flask app
-app = Flask(__name__)
+# Log at INFO by default; per-message details are logged at DEBUG so production skips them
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger(__name__)
+
+# Load a local .env file in development only; deployed containers get their environment injected
+if os.environ.get('ENV') == 'development':
+    from dotenv import load_dotenv
+    load_dotenv()
 
 # Retrieve environment variables
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
 LINE_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET')
 GAS_WEB_APP_URL = os.environ.get('GAS_WEB_APP_URL')
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
+REDIS_URL = os.environ.get('REDIS_URL')
+
+# Fail at startup rather than on the first message if required settings are missing
+missing_env = [
+    name for name in ('LINE_CHANNEL_ACCESS_TOKEN', 'LINE_CHANNEL_SECRET', 'GAS_WEB_APP_URL', 'OPENAI_API_KEY')
+    if not globals()[name]
+]
+if missing_env:
+    raise RuntimeError(f"Missing required environment variables: {', '.join(missing_env)}")
 
-# Initialize LINE Bot API and Webhook Handler
+# Initialize LINE Bot API; webhook signatures are checked with the channel secret.
+# The async client holds a pooled aiohttp session, which has to be created on the running
+# event loop, so the client itself is set up in lifespan().
 line_config = LineConfiguration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-api_client = ApiClient(configuration=line_config)
-line_bot_api = MessagingApi(api_client=api_client)
-handler = WebhookHandler(channel_secret=LINE_CHANNEL_SECRET)
+api_client = None
+line_bot_api = None
+LINE_CHANNEL_SECRET_BYTES = LINE_CHANNEL_SECRET.encode('utf-8')
+
+# Shared async HTTP client for Google Apps Script calls so connections are kept alive.
+# GAS web apps answer with a redirect to googleusercontent.com, so redirects must be followed.
+gas_client = httpx.AsyncClient(
+    http2=True,
+    follow_redirects=True,
+    timeout=httpx.Timeout(10, connect=3.05),
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=50),
+)
+GAS_MAX_RETRIES = 3
+GAS_BACKOFF_FACTOR = 0.3
+GAS_RETRY_STATUSES = {502, 503, 504}
 
 # Initialize OpenAI API client
-client = OpenAI(api_key=OPENAI_API_KEY)
+client = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
-# Define the functions for OpenAI function calling
-functions = [
-    {
-        "name": "get_availability_today",
-        "description": "Retrieve the availability for today.",
-        "parameters": {
-            "type": "object",
-            "properties": {},
-            "required": [],
-            "additionalProperties": False
-        }
-    },
-    {
-        "name": "get_availability_tomorrow",
-        "description": "Retrieve the availability for tomorrow.",
-        "parameters": {
-            "type": "object",
-            "properties": {},
-            "required": [],
-            "additionalProperties": False
-        }
-    },
+# Messages are processed after the webhook has been acknowledged. Keep references to the
+# running tasks so they are not garbage collected before they finish.
+background_tasks = set()
+# Webhook event IDs seen recently, so redeliveries from LINE are not processed twice.
+# With REDIS_URL set they are shared by all workers; otherwise each process keeps its own.
+EVENT_DEDUP_TTL = 300
+redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True, max_connections=50) if REDIS_URL else None
+seen_event_ids = TTLCache(maxsize=10000, ttl=EVENT_DEDUP_TTL)
+# Final replies keyed on (normalized message, date), so repeated questions skip OpenAI
+reply_cache = TTLCache(maxsize=2048, ttl=60)
+# Google Apps Script results keyed on (command, date), so repeated polling skips GAS
+gas_cache = TTLCache(maxsize=256, ttl=30)
+# GAS lookups currently in flight, keyed like gas_cache
+gas_inflight = {}
+# (everything runs on the event loop thread, so these caches need no locking)
+# Reply tokens expire shortly after the event; past this age (seconds) push the message instead
+REPLY_TOKEN_MAX_AGE = 30
+
+
+# Open the LINE client on startup; finish in-flight messages and close pooled connections on shutdown
+@asynccontextmanager
+async def lifespan(app):
+    global api_client, line_bot_api
+    api_client = AsyncApiClient(configuration=line_config)
+    line_bot_api = AsyncMessagingApi(api_client=api_client)
+    yield
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+    await api_client.close()
+    await gas_client.aclose()
+    await client.close()
+    if redis_client is not None:
+        await redis_client.aclose()
+
+# Initialize FastAPI app
+app = FastAPI(lifespan=lifespan)
+
+# Define the functions for OpenAI function calling (a tuple, so it is never mutated between requests).
+# "today" and "tomorrow" are resolved by the model from the date in the system prompt.
+functions = (
     {
-        "name": "get_availability_specific",
-        "description": "Retrieve the availability for a specific date.",
+        "name": "get_availability",
+        "description": "Get golf bay availability for a date.",
         "parameters": {
             "type": "object",
             "properties": {
                 "date": {
                     "type": "string",
-                    "description": "The date to check availability for, in YYYY-MM-DD format."
+                    "description": "Date in YYYY-MM-DD format."
                 }
             },
             "required": ["date"],
             "additionalProperties": False
         }
-    }
-]
+    },
+)
+
+# Arguments GPT passes to get_availability
+class AvailabilityArgs(msgspec.Struct):
+    date: str
+
+# System prompt for GPT-4o-mini; only the current date is filled in per request
+SYSTEM_PROMPT_TEMPLATE = (
+    "You are a golf bay booking assistant. Today is {today}. "
+    "Check availability and answer questions concisely in plain text, without markdown. "
+    "If you need a date, ask for it in YYYY-MM-DD format."
+)
+
+# Messages that are plainly availability queries ("today", "availability tomorrow?", "2024-06-01"),
+# answered without calling OpenAI. The whole message must match so other questions still reach GPT.
+_FAST_PATH_PATTERN = r'^\s*(?:(?:check\s+)?availability\s+(?:for\s+|on\s+)?)?{}(?:\s+availability)?\s*\??\s*$'
+DATE_RE = re.compile(_FAST_PATH_PATTERN.format(r'(\d{4}-\d{2}-\d{2})'), re.I)
+TODAY_RE = re.compile(_FAST_PATH_PATTERN.format(r'(?:today|วันนี้)'), re.I)
+TOMORROW_RE = re.compile(_FAST_PATH_PATTERN.format(r'(?:tomorrow|พรุ่งนี้)'), re.I)
+
+# Current date string, cached until the next local midnight
+_today_cache = {"expires": 0.0, "value": None}
+
+def today_str():
+    now = time.time()
+    if now >= _today_cache["expires"]:
+        today = datetime.fromtimestamp(now)
+        next_midnight = datetime.combine(today.date() + timedelta(days=1), datetime.min.time())
+        _today_cache["value"] = today.strftime('%Y-%m-%d')
+        _today_cache["expires"] = next_midnight.timestamp()
+    return _today_cache["value"]
+
+# Label a date relative to today for replies, e.g. "tomorrow (2024-06-02)"
+def describe_date(date_obj, current_date_str):
+    days_ahead = (date_obj - datetime.strptime(current_date_str, '%Y-%m-%d').date()).days
+    relative = {0: "today", 1: "tomorrow"}.get(days_ahead)
+    date_str = date_obj.strftime('%Y-%m-%d')
+    return f"{relative} ({date_str})" if relative else date_str
+
+# Return the date an obvious availability query asks about, or None if GPT should handle it
+def match_availability_date(user_message, current_date_str):
+    today = datetime.strptime(current_date_str, '%Y-%m-%d').date()
+    if TODAY_RE.match(user_message):
+        return today
+    if TOMORROW_RE.match(user_message):
+        return today + timedelta(days=1)
+    match = DATE_RE.match(user_message)
+    if match:
+        try:
+            return datetime.strptime(match.group(1), '%Y-%m-%d').date()
+        except ValueError:
+            return None
+    return None
 
 # Function to call Google Apps Script for availability
-def call_google_apps_script(command, date: Optional[datetime.date] = None):
+async def call_google_apps_script(command, date: Optional[datetime.date] = None):
+    date_str = date.strftime('%Y-%m-%d') if date else None
+    cache_key = (command, date_str)
+    if cache_key in gas_cache:
+        return gas_cache[cache_key]
+
+    # Concurrent identical lookups wait on the same request. The shield keeps one cancelled
+    # caller from cancelling the request for everyone else.
+    task = gas_inflight.get(cache_key)
+    if task is None:
+        task = asyncio.create_task(fetch_google_apps_script(command, date_str, cache_key))
+        gas_inflight[cache_key] = task
+        task.add_done_callback(lambda _: gas_inflight.pop(cache_key, None))
+    return await asyncio.shield(task)
+
+# Perform the Google Apps Script request, caching successful results
+async def fetch_google_apps_script(command, date_str, cache_key):
     payload = {"events": [{"message": {"text": command}}]}
 
-    if date:
-        payload["events"][0]["message"]["date"] = date.strftime('%Y-%m-%d')
+    if date_str:
+        payload["events"][0]["message"]["date"] = date_str
+
+    response = None
+    for attempt in range(GAS_MAX_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(GAS_BACKOFF_FACTOR * 2 ** (attempt - 1))
+        try:
+            response = await gas_client.post(GAS_WEB_APP_URL, json=payload)
+        except httpx.HTTPError as e:
+            logger.warning("Google Apps Script request failed: %s", e)
+            response = None
+            continue
+        if response.status_code not in GAS_RETRY_STATUSES:
+            break
+
+    if response is None:
+        return {"error": "Could not reach Google Apps Script."}
 
-    response = requests.post(GAS_WEB_APP_URL, json=payload)
     if response.status_code == 200:
         try:
-            return response.json()
-        except json.JSONDecodeError:
+            data = orjson.loads(response.content)
+        except orjson.JSONDecodeError:
             return {"error": "Invalid JSON response from Google Apps Script."}
+        if 'error' not in data:
+            gas_cache[cache_key] = data
+        return data
     else:
         return {"error": f"Google Apps Script returned status code {response.status_code}"}
 
+# Render Google Apps Script availability data as a plain-text reply.
+# Expects a mapping of bay name to a list of free time slots, either at the top level or under
+# "availability"/"bays". Returns None for any other shape so the caller can fall back to GPT.
+def format_availability(data, date_label):
+    bays = data.get("availability", data.get("bays", data)) if isinstance(data, dict) else None
+    if not isinstance(bays, dict) or not bays:
+        return None
+    if not all(isinstance(slots, list) and all(isinstance(slot, str) for slot in slots) for slots in bays.values()):
+        return None
+
+    lines = [f"Availability for {date_label}:"]
+    for bay, slots in bays.items():
+        lines.append(f"{bay}: {', '.join(slots) if slots else 'fully booked'}")
+    return "\n".join(lines)
+
+# Record a webhook event ID, returning True if it was already seen
+async def is_duplicate_event(event_id):
+    if redis_client is not None:
+        try:
+            return not await redis_client.set(f"evt:{event_id}", "1", nx=True, ex=EVENT_DEDUP_TTL)
+        except redis.RedisError as e:
+            logger.warning("Redis unavailable, falling back to in-memory dedup: %s", e)
+
+    if event_id in seen_event_ids:
+        return True
+    seen_event_ids[event_id] = True
+    return False
+
+# Send a plain text reply through the LINE Messaging API
+async def send_reply(event, text):
+    messages = [TextMessage(text=text)]
+    event_age = time.time() - event.timestamp / 1000
+
+    if event_age < REPLY_TOKEN_MAX_AGE:
+        reply_message_request = ReplyMessageRequest(reply_token=event.reply_token, messages=messages)
+        await line_bot_api.reply_message(reply_message_request)
+    else:
+        source = event.source
+        to = getattr(source, 'group_id', None) or getattr(source, 'room_id', None) or source.user_id
+        push_message_request = PushMessageRequest(to=to, messages=messages)
+        await line_bot_api.push_message(push_message_request)
+
 # Webhook callback endpoint
-@app.route("/callback", methods=['POST'])
-def callback():
+@app.post("/callback")
+async def callback(request: Request):
     # Get request body and signature
-    signature = request.headers.get('X-Line-Signature')
-    body = request.get_data(as_text=True)
-    print(f"Request body: {body}")  # Debugging
+    signature = request.headers.get('X-Line-Signature', '')
+    body = await request.body()
+    logger.debug("Request body: %s", body)
+
+    # Check the signature on the raw bytes before doing any parsing work
+    expected_signature = base64.b64encode(hmac.new(LINE_CHANNEL_SECRET_BYTES, body, hashlib.sha256).digest())
+    if not hmac.compare_digest(expected_signature, signature.encode('utf-8')):
+        logger.warning("Invalid signature. Check your LINE_CHANNEL_SECRET.")
+        return PlainTextResponse('Invalid signature', status_code=400)
 
     try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
-        print("Invalid signature. Check your LINE_CHANNEL_SECRET.")
-        return 'Invalid signature', 400
+        event_jsons = orjson.loads(body)['events']
     except Exception as e:
-        print(f"Exception in callback: {e}")
-        return 'Internal Server Error', 500
+        logger.exception("Exception in callback: %s", e)
+        return PlainTextResponse('Internal Server Error', status_code=500)
 
-    return 'OK'
+    # Acknowledge right away and handle the messages in the background. Events are filtered
+    # and deduplicated on the parsed JSON, so skipped ones are never built into SDK models.
+    for event_json in event_jsons:
+        if event_json.get('type') != 'message' or event_json.get('message', {}).get('type') != 'text':
+            continue
+        event_id = event_json.get('webhookEventId')
+        if event_id and await is_duplicate_event(event_id):
+            logger.debug("Skipping duplicate event: %s", event_id)
+            continue
+        try:
+            event = MessageEvent.from_dict(event_json)
+        except ValueError as e:
+            logger.warning("Ignoring malformed message event %s: %s", event_id, e)
+            continue
+
+        task = asyncio.create_task(process_event(event))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+    return PlainTextResponse('OK')
+
+# Run the message handler outside the request, logging anything it raises
+async def process_event(event):
+    try:
+        await handle_message(event)
+    except Exception as e:
+        logger.exception("Exception while handling message: %s", e)
+
+# Collapse case and whitespace so trivially different messages share a cache entry
+def normalize_message(text):
+    return re.sub(r'\s+', ' ', text.strip().lower())
 
 # Message event handler
-@handler.add(MessageEvent, message=TextMessageContent)
-def handle_message(event):
+async def handle_message(event):
     user_message = event.message.text.strip()
-    reply_token = event.reply_token
-    user_id = event.source.user_id
-    print(f"User ID: {user_id}, Message: {user_message}")  # Debugging
+    logger.debug("User ID: %s, Message: %s", event.source.user_id, user_message)
 
     # Get the current date
-    current_date_str = datetime.now().strftime('%Y-%m-%d')
+    current_date_str = today_str()
+
+    # Answer repeated questions from the cache; the date is part of the key so entries roll over at midnight
+    cache_key = (normalize_message(user_message), current_date_str)
+    reply = reply_cache.get(cache_key)
+    if reply is None:
+        reply, cacheable = await generate_reply(user_message, current_date_str)
+        if cacheable:
+            reply_cache[cache_key] = reply
+
+    await send_reply(event, reply)
+
+# Work out the reply text for a message; error replies are flagged as not cacheable
+async def generate_reply(user_message, current_date_str):
+    # Fast path: answer obvious availability queries directly from GAS. Anything that can't be
+    # formatted locally falls through to GPT, which reuses the cached GAS result.
+    date_obj = match_availability_date(user_message, current_date_str)
+    if date_obj is not None:
+        response_data = await call_google_apps_script('availability_specific', date_obj)
+        if 'error' not in response_data:
+            formatted = format_availability(response_data, describe_date(date_obj, current_date_str))
+            if formatted is not None:
+                return formatted, True
 
+    # While GPT decides, start the lookups for today and tomorrow, the dates most often asked
+    # about. If GPT picks one of them, call_google_apps_script joins the in-flight request
+    # instead of starting a new one. Unused waiters are cancelled; the lookup itself still
+    # completes and fills gas_cache.
+    today = datetime.strptime(current_date_str, '%Y-%m-%d').date()
+    prefetches = [
+        asyncio.create_task(call_google_apps_script('availability_specific', day))
+        for day in (today, today + timedelta(days=1))
+    ]
+    try:
+        return await ask_gpt(user_message, current_date_str)
+    finally:
+        for task in prefetches:
+            task.cancel()
+
+# Let GPT answer the message, calling get_availability when it needs availability data
+async def ask_gpt(user_message, current_date_str):
     # Define the conversation for GPT-4o-mini with current date and instructions
     messages = [
-        {
-            "role": "system",
-            "content": (
-                f"You are a helpful assistant that can check golf bay availability and answer other questions. "
-                f"Today's date is {current_date_str}. "
-                "When providing availability information, present it in plain text without any markdown or special formatting characters. "
-                "Please be concise and focus on delivering the necessary information. "
-                "When asking the user for a date, request it in YYYY-MM-DD format."
-            )
-        },
+        {"role": "system", "content": SYSTEM_PROMPT_TEMPLATE.format(today=current_date_str)},
         {"role": "user", "content": user_message}
     ]
 
     # GPT-4o-mini response with function calling
     try:
-        session = client.chat.completions.create(
+        session = await client.chat.completions.create(
             model="gpt-4o-mini",
             messages=messages,
             functions=functions,
-            function_call="auto"
+            function_call="auto",
+            max_tokens=200,
+            temperature=0
         )
         assistant_message = session.choices[0].message
 
     except Exception as e:
-        print(f"OpenAI API error: {e}")  # Debugging
-        reply_message_request = ReplyMessageRequest(
-            reply_token=reply_token,
-            messages=[TextMessage(text="Sorry, I encountered an error while processing your request.")]
-        )
-        line_bot_api.reply_message(reply_message_request)
-        return
-
-    if assistant_message.function_call:
-        function_call = assistant_message.function_call
-        function_name = function_call.name
-        function_args = function_call.arguments or '{}'
-
-        # Execute the function and get the result
-        function_response = ""
-
-        if function_name == "get_availability_today":
-            # Execute the function and capture the output
-            response_data = call_google_apps_script('availability_today')
-        elif function_name == "get_availability_tomorrow":
-            response_data = call_google_apps_script('availability_tomorrow')
-        elif function_name == "get_availability_specific":
-            args = json.loads(function_args)
-            date_str = args.get("date")
-            if date_str:
-                try:
-                    date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
-                    response_data = call_google_apps_script('availability_specific', date_obj)
-                except ValueError:
-                    # Send a message asking for a valid date
-                    reply_message_request = ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[TextMessage(text="Please provide a valid date in YYYY-MM-DD format.")]
-                    )
-                    line_bot_api.reply_message(reply_message_request)
-                    return
-            else:
-                # Ask the user to provide a date
-                reply_message_request = ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text="Please specify the date you want to check availability for (YYYY-MM-DD).")]
-                )
-                line_bot_api.reply_message(reply_message_request)
-                return
-        else:
-            reply_message_request = ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[TextMessage(text="I'm sorry, I can't handle that request right now.")]
-            )
-            line_bot_api.reply_message(reply_message_request)
-            return
-
-        # Prepare the function response as a string
-        if 'error' in response_data:
-            function_response = f"Error: {response_data['error']}"
-        else:
-            function_response = json.dumps(response_data)
-
-        # Append the function response to the messages
-        messages.append({
-            "role": "assistant",
-            "content": None,
-            "function_call": {
-                "name": function_name,
-                "arguments": function_args
-            }
-        })
-
-        messages.append({
-            "role": "function",
+        logger.error("OpenAI API error: %s", e)
+        return "Sorry, I encountered an error while processing your request.", False
+
+    if not assistant_message.function_call:
+        # If no function call, reply with GPT's message
+        if assistant_message.content:
+            return assistant_message.content, True
+        return "Sorry, I didn't understand that.", False
+
+    function_call = assistant_message.function_call
+    function_name = function_call.name
+    function_args = function_call.arguments or '{}'
+
+    if function_name != "get_availability":
+        return "I'm sorry, I can't handle that request right now.", False
+
+    # Decoding against the schema also rejects a missing or non-string date
+    try:
+        date_str = msgspec.json.decode(function_args, type=AvailabilityArgs).date
+    except msgspec.DecodeError:
+        date_str = None
+    if not date_str:
+        # Ask the user to provide a date
+        return "Please specify the date you want to check availability for (YYYY-MM-DD).", True
+    try:
+        date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
+    except ValueError:
+        # Ask for a valid date
+        return "Please provide a valid date in YYYY-MM-DD format.", True
+
+    # Execute the function and get the result
+    response_data = await call_google_apps_script('availability_specific', date_obj)
+    date_label = describe_date(date_obj, current_date_str)
+
+    if 'error' in response_data:
+        logger.warning("Google Apps Script error: %s", response_data['error'])
+        return "Sorry, I couldn't check availability right now. Please try again later.", False
+
+    # Format known availability data locally instead of asking GPT to do it
+    formatted = format_availability(response_data, date_label)
+    if formatted is not None:
+        return formatted, True
+
+    # Unexpected payload shape: let GPT turn it into a reply
+    function_response = msgspec.json.encode(response_data).decode()
+
+    # Append the function response to the messages
+    messages.append({
+        "role": "assistant",
+        "content": None,
+        "function_call": {
             "name": function_name,
-            "content": function_response
-        })
+            "arguments": function_args
+        }
+    })
 
-        # Call the model again to get the final answer
-        try:
-            second_session = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages
-            )
-            final_response = second_session.choices[0].message.content
-
-            # Send the assistant's response to the user
-            reply_message_request = ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[TextMessage(text=final_response)]
-            )
-            line_bot_api.reply_message(reply_message_request)
-        except Exception as e:
-            print(f"OpenAI API error during second call: {e}")
-            reply_message_request = ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[TextMessage(text="Sorry, I encountered an error while processing your request.")]
-            )
-            line_bot_api.reply_message(reply_message_request)
+    messages.append({
+        "role": "function",
+        "name": function_name,
+        "content": function_response
+    })
 
-    else:
-        # If no function call, reply with GPT's message
-        reply_text = assistant_message.content or "Sorry, I didn't understand that."
-        reply_message_request = ReplyMessageRequest(
-            reply_token=reply_token,
-            messages=[TextMessage(text=reply_text)]
+    # Call the model again to get the final answer, streaming tokens as they are generated.
+    # LINE replies are sent in one piece, so the chunks are collected and joined at the end.
+    try:
+        stream = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            stream=True,
+            max_tokens=350,
+            temperature=0
         )
-        line_bot_api.reply_message(reply_message_request)
+        chunks = []
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                chunks.append(chunk.choices[0].delta.content)
+        final_response = "".join(chunks)
+    except Exception as e:
+        logger.error("OpenAI API error during second call: %s", e)
+        return "Sorry, I encountered an error while processing your request.", False
+
+    if not final_response:
+        return "Sorry, I encountered an error while processing your request.", False
+    return final_response, True
 
 if __name__ == '__main__':
+    import uvicorn
     port = int(os.environ.get('PORT', 8080))
-    app.run(host='0.0.0.0', port=port)
+    uvicorn.run(app, host='0.0.0.0', port=port)